@@ -6,8 +6,9 @@ import asyncio
 import logging
 from collections import deque
 import hashlib
-from typing import List, Dict
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from shared_state import SharedState, CACHE_SIZE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,13 +19,12 @@ load_dotenv()
 
 # Constants
 BATCH_SIZE = 50
-CACHE_SIZE = 1000
 
 class DimensionMismatchError(Exception):
     pass
 
 class EmbeddingManager:
-    def __init__(self):
+    def __init__(self, shared_state: Optional[SharedState] = None):
         self.GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
         self.PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
         
@@ -43,12 +43,28 @@ class EmbeddingManager:
         # Initialize cache
         self.embedding_cache = {}
         self.cache_queue = deque(maxlen=CACHE_SIZE)
+        # Cache shared with the other workers when serving multi-process
+        self.shared_state = shared_state
+        # Query embeddings waiting for flush_shared_cache
+        self.pending_shared: Dict[str, List[float]] = {}
 
     def get_cache_key(self, text: str) -> str:
         return hashlib.md5(text.encode()).hexdigest()
 
     def cache_embedding(self, text: str, embedding: List[float]):
         key = self.get_cache_key(text)
+        self._cache_local(key, embedding)
+        if self.shared_state is not None:
+            # Published in batches by flush_shared_cache, off the request path
+            self.pending_shared[key] = embedding
+
+    async def flush_shared_cache(self):
+        if self.shared_state is None or not self.pending_shared:
+            return
+        pending, self.pending_shared = self.pending_shared, {}
+        await asyncio.to_thread(self.shared_state.cache_embeddings, pending)
+
+    def _cache_local(self, key: str, embedding: List[float]):
         if key not in self.embedding_cache:
             if len(self.cache_queue) >= CACHE_SIZE:
                 old_key = self.cache_queue.popleft()
@@ -57,7 +73,11 @@ class EmbeddingManager:
         self.embedding_cache[key] = embedding
 
     def get_cached_embedding(self, text: str) -> List[float]:
-        return self.embedding_cache.get(self.get_cache_key(text))
+        key = self.get_cache_key(text)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None and self.shared_state is not None:
+            embedding = self.shared_state.get_cached_embedding(key)
+        return embedding
 
     async def initialize_index(self, dimension: int):
         try:
@@ -104,6 +124,12 @@ class EmbeddingManager:
             logger.error(f"Error initializing index: {str(e)}")
             raise
 
+    def open_index(self):
+        # Index handle for workers that have not run initialize_index
+        if self.index is None:
+            self.index = self.pc.Index(self.index_name)
+        return self.index
+
     async def get_embedding_dimension(self, text: str) -> int:
         try:
             embedding = await asyncio.to_thread(
@@ -123,8 +149,10 @@ class EmbeddingManager:
         texts_to_process = []
         indices_to_process = []
 
-        for i, text in enumerate(texts):
-            cached_embedding = self.get_cached_embedding(text)
+        cached_embeddings = await asyncio.to_thread(
+            lambda: [self.get_cached_embedding(text) for text in texts]
+        )
+        for i, (text, cached_embedding) in enumerate(zip(texts, cached_embeddings)):
             if cached_embedding is not None:
                 results.append((i, cached_embedding))
             else:
@@ -143,8 +171,14 @@ class EmbeddingManager:
                 ) for text in texts_to_process]
             )
 
+            new_entries = {}
             for text, embedding in zip(texts_to_process, embeddings):
-                self.cache_embedding(text, embedding)
+                key = self.get_cache_key(text)
+                self._cache_local(key, embedding)
+                new_entries[key] = embedding
+            if self.shared_state is not None:
+                # One generation per batch rather than one per text
+                await asyncio.to_thread(self.shared_state.cache_embeddings, new_entries)
 
             results.extend(zip(indices_to_process, embeddings))
 
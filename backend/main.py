@@ -4,7 +4,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
-from typing import List, Dict
+from typing import List
 import logging
 import hashlib
 from io import BytesIO
@@ -13,6 +13,7 @@ import google.generativeai as genai
 from document_processing import process_document_content, validate_file_type, SUPPORTED_MIMETYPES
 from embedding import EmbeddingManager, BATCH_SIZE
 from chunking import chunk_text
+from shared_state import SharedState
 # Import the function
 app = FastAPI()
 # Configure logging
@@ -30,12 +31,60 @@ app.add_middleware(
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Storage shared by every worker process
+shared_state = SharedState()
+
 # Initialize embedding manager
-embedding_manager = EmbeddingManager()
+embedding_manager = EmbeddingManager(shared_state)
+
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 300))  # seconds
+CACHE_FLUSH_INTERVAL = int(os.getenv('CACHE_FLUSH_INTERVAL', 10))  # seconds
+
+async def flush_cache_periodically():
+    while True:
+        await asyncio.sleep(CACHE_FLUSH_INTERVAL)
+        try:
+            await embedding_manager.flush_shared_cache()
+        except Exception as e:
+            logger.error(f"Error flushing shared embedding cache: {str(e)}")
+
+async def snapshot_periodically():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        # One worker takes the snapshots; another takes over if it exits
+        if not await asyncio.to_thread(shared_state.claim_snapshot_writer):
+            continue
+        try:
+            await asyncio.to_thread(shared_state.snapshot)
+        except Exception as e:
+            logger.error(f"Error writing snapshot: {str(e)}")
+
+@app.on_event("startup")
+async def start_snapshots():
+    app.state.snapshot_task = asyncio.create_task(snapshot_periodically())
+
+@app.on_event("startup")
+async def start_cache_flush():
+    app.state.cache_flush_task = asyncio.create_task(flush_cache_periodically())
+
+@app.on_event("shutdown")
+async def stop_cache_flush():
+    app.state.cache_flush_task.cancel()
+    try:
+        await embedding_manager.flush_shared_cache()
+    except Exception as e:
+        logger.error(f"Error flushing shared embedding cache on shutdown: {str(e)}")
 
-# Storage
-uploaded_documents: Dict[str, List[str]] = {}
-processing_status = {}
+@app.on_event("shutdown")
+async def stop_snapshots():
+    app.state.snapshot_task.cancel()
+    # Changes since the last snapshot are in the write-ahead log either way;
+    # folding them in now keeps the next startup from replaying them
+    try:
+        if await asyncio.to_thread(shared_state.claim_snapshot_writer):
+            await asyncio.to_thread(shared_state.snapshot)
+    except Exception as e:
+        logger.error(f"Error writing snapshot on shutdown: {str(e)}")
 
 class Query(BaseModel):
     question: str
@@ -70,10 +119,6 @@ async def process_chunks_batch(chunks: List[dict], file_name: str, task_id: str)
                 
             vector_id = f"{file_name}-chunk-{chunk['index']}"
             
-            if file_name not in uploaded_documents:
-                uploaded_documents[file_name] = []
-            uploaded_documents[file_name].append(vector_id)
-            
             vectors.append({
                 'id': vector_id,
                 'values': embedding,
@@ -86,32 +131,29 @@ async def process_chunks_batch(chunks: List[dict], file_name: str, task_id: str)
         
         if vectors:
             await asyncio.to_thread(lambda: embedding_manager.index.upsert(vectors=vectors))
+            await asyncio.to_thread(shared_state.add_document_vectors, file_name, [v['id'] for v in vectors])
         
-        processing_status[task_id]['processed_chunks'] += len(chunks)
-        processing_status[task_id]['progress'] = (
-            processing_status[task_id]['processed_chunks'] / 
-            processing_status[task_id]['total_chunks']
-        ) * 100
+        await asyncio.to_thread(shared_state.add_processed_chunks, task_id, len(chunks))
         
     except embedding_manager.DimensionMismatchError as e:
         logger.error(str(e))
-        processing_status[task_id]['status'] = 'failed'
-        processing_status[task_id]['error'] = str(e)
+        await asyncio.to_thread(shared_state.update_status, task_id, status='failed', error=str(e))
         raise
     except Exception as e:
         logger.error(f"Error processing batch: {str(e)}")
-        processing_status[task_id]['status'] = 'failed'
-        processing_status[task_id]['error'] = str(e)
+        await asyncio.to_thread(shared_state.update_status, task_id, status='failed', error=str(e))
         raise
 
 async def process_document(file_bytes: bytes, filename: str, task_id: str):
     try:
         text_chunks = await process_document_content(file_bytes, filename)
         
-        processing_status[task_id].update({
-            'total_chunks': len(text_chunks),
-            'processed_chunks': 0
-        })
+        await asyncio.to_thread(
+            shared_state.update_status,
+            task_id,
+            total_chunks=len(text_chunks),
+            processed_chunks=0
+        )
         
         tasks = []
         for i in range(0, len(text_chunks), BATCH_SIZE):
@@ -120,12 +162,11 @@ async def process_document(file_bytes: bytes, filename: str, task_id: str):
             tasks.append(task)
         
         await asyncio.gather(*tasks)
-        processing_status[task_id]['status'] = 'completed'
+        await asyncio.to_thread(shared_state.update_status, task_id, status='completed')
         
     except Exception as e:
         logger.error(f"Error processing document: {str(e)}")
-        processing_status[task_id]['status'] = 'failed'
-        processing_status[task_id]['error'] = str(e)
+        await asyncio.to_thread(shared_state.update_status, task_id, status='failed', error=str(e))
         raise
 
 from fastapi import FastAPI, Depends, HTTPException
@@ -200,13 +241,13 @@ async def upload_document(
         
         task_id = f"task_{hashlib.md5(file.filename.encode()).hexdigest()}"
         
-        processing_status[task_id] = {
+        await asyncio.to_thread(shared_state.set_status, task_id, {
             'status': 'processing',
             'progress': 0,
             'processed_chunks': 0,
             'total_chunks': 0,
             'filename': file.filename
-        }
+        })
         
         background_tasks.add_task(
             process_document,
@@ -233,27 +274,30 @@ async def upload_document(
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    if task_id not in processing_status:
+    status = await asyncio.to_thread(shared_state.get_status, task_id)
+    if status is None:
         return {"status": "not_found"}
-    return processing_status[task_id]
+    return status
 
 @app.get("/documents")
 async def list_documents():
-    return {"documents": list(uploaded_documents.keys())}
+    return {"documents": await asyncio.to_thread(shared_state.list_documents)}
 
 @app.delete("/documents/{filename}")
 async def delete_document(filename: str):
     try:
-        if filename not in uploaded_documents:
+        vector_ids = await asyncio.to_thread(shared_state.get_document_vectors, filename)
+        if vector_ids is None:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        vector_ids = uploaded_documents[filename]
+        # Listed documents may have been uploaded through another worker
+        index = await asyncio.to_thread(embedding_manager.open_index)
         batch_size = 100
         for i in range(0, len(vector_ids), batch_size):
             batch = vector_ids[i:i + batch_size]
-            embedding_manager.index.delete(ids=batch)
+            await asyncio.to_thread(lambda: index.delete(ids=batch))
         
-        del uploaded_documents[filename]
+        await asyncio.to_thread(shared_state.remove_document, filename)
         return {"message": f"Document '{filename}' deleted successfully"}
     except Exception as e:
         logger.error(f"Error deleting document: {str(e)}")
@@ -262,7 +306,7 @@ async def delete_document(filename: str):
 @app.post("/query")
 async def query_document(query: Query):
     try:
-        query_embedding = embedding_manager.get_cached_embedding(query.question)
+        query_embedding = await asyncio.to_thread(embedding_manager.get_cached_embedding, query.question)
         if not query_embedding:
             query_embedding = await asyncio.to_thread(
                 lambda: genai.embed_content(
@@ -316,4 +360,7 @@ Answer:"""
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Workers share the index and cache through STATE_DIR; uvicorn needs the
+    # import string rather than the app object to spawn more than one
+    workers = int(os.getenv('WORKERS', 1))
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, workers=workers)
@@ -0,0 +1,392 @@
+import os
+import shutil
+import logging
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Optional
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from snapshot import SnapshotError, write_snapshot, load_snapshot, encode_wal_record, read_wal
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Constants
+STATE_DIR = os.getenv('STATE_DIR', 'state')
+CACHE_SIZE = 1000
+KEY_DTYPE = 'S32'  # md5 hex digest
+MAX_REFRESH_ATTEMPTS = 3
+FINISHED_STATUS_TTL = int(os.getenv('FINISHED_STATUS_TTL', 3600))  # seconds
+FINISHED_STATUSES = ('completed', 'failed')
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    if os.name == 'nt':
+        # Signal 0 is CTRL_C_EVENT on Windows; leave these to the status TTL
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class SharedState:
+    """
+    Document registry, processing status and embedding cache shared by all
+    uvicorn workers through files in a common state directory.
+
+    Changes are applied by a single writer holding an exclusive lock. The
+    registry lives in a snapshot plus a write-ahead log of the changes made
+    since; snapshot() folds the log into a new snapshot and publishes it by
+    swapping the pointer file with os.replace. Readers replay new log records
+    on access, following the log across generations, and reload a snapshot
+    only when they have fallen too far behind. The cache matrix is opened
+    with mmap so every worker shares the same page cache instead of a copy.
+    """
+
+    def __init__(self, state_dir: str = STATE_DIR):
+        self.state_dir = state_dir
+        os.makedirs(self.state_dir, exist_ok=True)
+        # Guards the in-memory view; callers reach it from worker threads
+        self._mutex = threading.RLock()
+        self._snapshot_lock_file = None
+
+        self._generation = -1
+        self._wal_offset = 0
+        self._registry = {'documents': {}, 'status': {}}
+
+        self._cache_generation = -1
+        self._cache_keys = np.empty(0, dtype=KEY_DTYPE)
+        self._cache_vectors = np.empty((0, 0), dtype=np.float32)
+        self._cache_index: Dict[bytes, int] = {}
+
+        # Fail at startup rather than on the first request
+        self._refresh()
+
+    @contextmanager
+    def _writer(self, lock_name: str = '.lock'):
+        with self._mutex, open(self._path(lock_name), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after ten seconds, keep waiting
+                        continue
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.state_dir, name)
+
+    def _read_generation(self, pointer: str) -> int:
+        try:
+            with open(self._path(pointer)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _atomic_write(self, name: str, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path(name))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _publish(self, pointer: str, generation: int, stale_files: List[str]):
+        self._atomic_write(pointer, lambda f: f.write(str(generation).encode()))
+        # The previous generation is kept for readers that have just read the
+        # old pointer; anything older is unlinked. Workers that still map an
+        # unlinked generation keep their view until they unmap it.
+        for name in stale_files:
+            path = self._path(name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # Already gone, or still mapped by a reader on Windows
+                    pass
+
+    # Document registry and processing status
+
+    def _replay(self, start: int, end: int):
+        """
+        Apply the logs of generations start..end, continuing the first one
+        from the current offset. Raises FileNotFoundError if a log that is
+        needed has already been removed.
+        """
+        for generation in range(start, end + 1):
+            offset = self._wal_offset if generation == start else 0
+            try:
+                records, offset = read_wal(self._path(f'wal-{generation}.log'), offset)
+            except FileNotFoundError:
+                # Only a fresh start before anything was logged has no wal-0;
+                # otherwise records were lost to a snapshot and we must reload
+                if not (start == end == 0 and offset == 0):
+                    raise
+                records = []
+            for record in records:
+                self._apply(record)
+            self._generation, self._wal_offset = generation, offset
+
+    def _load(self, generation: int):
+        """
+        Rebuild the registry from the snapshot of the given generation, or
+        from the previous snapshot and its log if that one is unreadable.
+        """
+        for _ in range(MAX_REFRESH_ATTEMPTS):
+            for base in (generation, generation - 1):
+                if base < 0:
+                    continue
+                try:
+                    if base == 0:
+                        self._registry = {'documents': {}, 'status': {}}
+                    else:
+                        self._registry = load_snapshot(self._path(f'snapshot-{base}'))
+                    self._generation, self._wal_offset = base, 0
+                    self._replay(base, generation)
+                except (OSError, ValueError, KeyError, SnapshotError) as e:
+                    logger.warning(f"Could not restore from snapshot {base}: {str(e)}")
+                    continue
+                if base != generation:
+                    logger.warning(f"Snapshot {generation} is unusable, restored from snapshot {base} and its log")
+                return
+
+            latest = self._read_generation('snapshot.current')
+            if latest == generation:
+                break
+            # Superseded while we were loading, try the new generation
+            generation = latest
+
+        self._generation = -1
+        raise SnapshotError(f"No usable snapshot for generation {generation} in {self.state_dir}")
+
+    def _refresh(self):
+        with self._mutex:
+            generation = self._read_generation('snapshot.current')
+            if self._generation >= 0:
+                try:
+                    self._replay(self._generation, generation)
+                    return
+                except FileNotFoundError:
+                    # Fell behind by more than one snapshot
+                    pass
+            self._load(generation)
+
+    def _apply(self, record: dict):
+        op = record['op']
+        documents, status = self._registry['documents'], self._registry['status']
+
+        if op == 'add_vectors':
+            documents.setdefault(record['filename'], []).extend(record['vector_ids'])
+        elif op == 'remove_document':
+            documents.pop(record['filename'], None)
+        elif op == 'set_status':
+            status[record['task_id']] = record['status']
+        elif op == 'update_status':
+            status.setdefault(record['task_id'], {}).update(record['fields'])
+        elif op == 'add_processed_chunks':
+            task = status.get(record['task_id'])
+            if task and task.get('total_chunks'):
+                task['processed_chunks'] += record['count']
+                task['progress'] = (task['processed_chunks'] / task['total_chunks']) * 100
+        else:
+            # A record that cannot be applied must not stop the replay
+            logger.warning(f"Skipping unknown log operation: {op}")
+
+    def _log(self, record: dict):
+        line = encode_wal_record(record)
+        with self._writer():
+            self._refresh()
+            with open(self._path(f'wal-{self._generation}.log'), 'ab') as f:
+                # Drop a torn record left by a writer that crashed mid-append
+                f.truncate(self._wal_offset)
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._wal_offset += len(line)
+            self._apply(record)
+
+    def claim_snapshot_writer(self) -> bool:
+        """
+        Try to become the one process that takes snapshots. The claim lasts
+        until this process exits, so another worker takes over after that.
+        """
+        if self._snapshot_lock_file is not None:
+            return True
+        lock_file = open(self._path('.snapshot.lock'), 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self._snapshot_lock_file = lock_file
+        return True
+
+    def snapshot(self) -> bool:
+        """
+        Fold the write-ahead log into a new snapshot. Returns False when
+        nothing has been logged since the last one.
+        """
+        with self._writer():
+            self._refresh()
+            if self._wal_offset == 0:
+                return False
+
+            self._prune_statuses()
+
+            # The previous snapshot and its log stay on disk as the fallback
+            old = self._generation
+            new = old + 1
+            write_snapshot(self._path(f'snapshot-{new}'), self._registry)
+            self._atomic_write(f'wal-{new}.log', lambda f: None)
+            self._publish('snapshot.current', new, [f'snapshot-{old - 1}', f'wal-{old - 1}.log'])
+            self._generation, self._wal_offset = new, 0
+            logger.info(f"Wrote snapshot {new} with {len(self._registry['documents'])} documents")
+            return True
+
+    def _prune_statuses(self):
+        # Keep finished tasks long enough for clients to see the outcome, and
+        # drop tasks whose worker died before finishing them
+        now = time.time()
+        status = self._registry['status']
+        for task_id, task in list(status.items()):
+            if task.get('status') in FINISHED_STATUSES:
+                if now - task.get('finished_at', 0) > FINISHED_STATUS_TTL:
+                    del status[task_id]
+            elif not _process_alive(task.get('pid')):
+                del status[task_id]
+
+    def list_documents(self) -> List[str]:
+        with self._mutex:
+            self._refresh()
+            return list(self._registry['documents'].keys())
+
+    def get_document_vectors(self, filename: str) -> Optional[List[str]]:
+        with self._mutex:
+            self._refresh()
+            vector_ids = self._registry['documents'].get(filename)
+            # A copy, since log replay in another thread extends the list
+            return list(vector_ids) if vector_ids is not None else None
+
+    def add_document_vectors(self, filename: str, vector_ids: List[str]):
+        self._log({'op': 'add_vectors', 'filename': filename, 'vector_ids': vector_ids})
+
+    def remove_document(self, filename: str):
+        self._log({'op': 'remove_document', 'filename': filename})
+
+    def get_status(self, task_id: str) -> Optional[dict]:
+        with self._mutex:
+            self._refresh()
+            task = self._registry['status'].get(task_id)
+            if task is None:
+                return None
+            pid = task.get('pid')
+            status = {k: v for k, v in task.items() if k not in ('pid', 'finished_at')}
+        if status.get('status') not in FINISHED_STATUSES and not _process_alive(pid):
+            # The worker processing it exited, e.g. across a restart
+            status['status'] = 'failed'
+            status['error'] = 'Processing was interrupted before it finished'
+        return status
+
+    def set_status(self, task_id: str, status: dict):
+        # The owning worker, so a task orphaned by a restart is not reported
+        # as processing forever
+        status = dict(status, pid=os.getpid())
+        self._log({'op': 'set_status', 'task_id': task_id, 'status': status})
+
+    def update_status(self, task_id: str, **fields):
+        if fields.get('status') in FINISHED_STATUSES:
+            fields['finished_at'] = time.time()
+        self._log({'op': 'update_status', 'task_id': task_id, 'fields': fields})
+
+    def add_processed_chunks(self, task_id: str, count: int):
+        self._log({'op': 'add_processed_chunks', 'task_id': task_id, 'count': count})
+
+    # Embedding cache
+
+    def _refresh_cache(self):
+        for _ in range(MAX_REFRESH_ATTEMPTS):
+            generation = self._read_generation('cache.current')
+            if generation == self._cache_generation or generation == 0:
+                self._cache_generation = generation
+                return
+            try:
+                keys = np.load(self._path(f'cache-{generation}.keys.npy'))
+                vectors = np.load(self._path(f'cache-{generation}.vectors.npy'), mmap_mode='r')
+            except FileNotFoundError:
+                # Superseded while we were reading the pointer, try again
+                continue
+            self._cache_keys = keys
+            self._cache_vectors = vectors
+            self._cache_index = {key: row for row, key in enumerate(keys.tolist())}
+            self._cache_generation = generation
+            return
+        # The cache is only an optimisation; keep serving the view we have
+        logger.warning(f"Shared embedding cache generation {generation} is missing, keeping the previous one")
+
+    def get_cached_embedding(self, key: str) -> Optional[List[float]]:
+        with self._mutex:
+            self._refresh_cache()
+            row = self._cache_index.get(key.encode())
+            if row is None:
+                return None
+            return self._cache_vectors[row].tolist()
+
+    def cache_embeddings(self, embeddings: Dict[str, List[float]]):
+        if not embeddings:
+            return
+        # Separate lock so cache publishes never hold up registry writes
+        with self._writer('.cache.lock'):
+            self._refresh_cache()
+            new_keys = [k.encode() for k in embeddings if k.encode() not in self._cache_index]
+            if not new_keys:
+                return
+
+            new_vectors = np.asarray([embeddings[k.decode()] for k in new_keys], dtype=np.float32)
+            if len(self._cache_keys) and self._cache_vectors.shape[1] == new_vectors.shape[1]:
+                keys = np.concatenate([self._cache_keys, np.asarray(new_keys, dtype=KEY_DTYPE)])
+                vectors = np.concatenate([self._cache_vectors, new_vectors])
+            else:
+                # Empty cache or the embedding model changed dimension
+                keys = np.asarray(new_keys, dtype=KEY_DTYPE)
+                vectors = new_vectors
+            keys, vectors = keys[-CACHE_SIZE:], vectors[-CACHE_SIZE:]
+
+            old = self._cache_generation
+            new = old + 1
+            self._atomic_write(f'cache-{new}.keys.npy', lambda f: np.save(f, keys))
+            self._atomic_write(f'cache-{new}.vectors.npy', lambda f: np.save(f, vectors))
+            stale = [f'cache-{old - 1}.keys.npy', f'cache-{old - 1}.vectors.npy']
+            self._publish('cache.current', new, stale)
@@ -0,0 +1,98 @@
+import os
+import json
+import zlib
+import shutil
+import hashlib
+import logging
+from typing import List, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Constants
+SNAPSHOT_VERSION = 1
+REGISTRY_FILE = 'registry.json'
+MANIFEST_FILE = 'manifest.json'
+
+class SnapshotError(Exception):
+    pass
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_file(path: str, write):
+    with open(path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_snapshot(path: str, registry: dict):
+    """
+    Write a snapshot directory holding the document registry and a manifest
+    with the format version and a checksum of every file. The directory is
+    renamed into place only once it is complete.
+    """
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    try:
+        _write_file(os.path.join(tmp_path, REGISTRY_FILE), lambda f: f.write(json.dumps(registry).encode()))
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'checksums': {REGISTRY_FILE: _sha256(os.path.join(tmp_path, REGISTRY_FILE))}
+        }
+        _write_file(os.path.join(tmp_path, MANIFEST_FILE), lambda f: f.write(json.dumps(manifest).encode()))
+        # Left behind by a writer that crashed before publishing it
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def load_snapshot(path: str) -> dict:
+    """
+    Load the registry from a snapshot written by write_snapshot, checking
+    the format version and the checksum.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(
+            f"Unsupported snapshot version {manifest.get('version')} in {path}, expected {SNAPSHOT_VERSION}"
+        )
+
+    with open(os.path.join(path, REGISTRY_FILE), 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != manifest['checksums'][REGISTRY_FILE]:
+        raise SnapshotError(f"Checksum mismatch for {REGISTRY_FILE} in {path}")
+    return json.loads(data)
+
+def encode_wal_record(record: dict) -> bytes:
+    payload = json.dumps(record, separators=(',', ':')).encode()
+    return f"{zlib.crc32(payload):08x} ".encode() + payload + b"\n"
+
+def read_wal(path: str, offset: int) -> Tuple[List[dict], int]:
+    """
+    Read the write-ahead log from offset. Returns the decoded records and
+    the offset just past the last valid one; a torn or corrupt tail left
+    by a crash ends the replay.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            checksum, _, payload = line[:-1].partition(b" ")
+            if checksum != f"{zlib.crc32(payload):08x}".encode():
+                logger.warning(f"Corrupt record in {path} at offset {offset}, ignoring the rest of the log")
+                break
+            records.append(json.loads(payload))
+            offset += len(line)
+    return records, offset
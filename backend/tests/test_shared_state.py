@@ -0,0 +1,204 @@
+import os
+import sys
+import subprocess
+import threading
+import pytest
+import shared_state
+from shared_state import SharedState
+from snapshot import SnapshotError, encode_wal_record, read_wal
+
+def test_read_wal_stops_at_torn_tail(tmp_path):
+    wal = tmp_path / 'wal-0.log'
+    first = encode_wal_record({'op': 'remove_document', 'filename': 'a.pdf'})
+    wal.write_bytes(first + encode_wal_record({'op': 'remove_document', 'filename': 'b.pdf'})[:-5])
+
+    records, offset = read_wal(str(wal), 0)
+
+    assert records == [{'op': 'remove_document', 'filename': 'a.pdf'}]
+    assert offset == len(first)
+
+def test_read_wal_rejects_bad_checksum(tmp_path):
+    wal = tmp_path / 'wal-0.log'
+    first = encode_wal_record({'op': 'remove_document', 'filename': 'a.pdf'})
+    second = encode_wal_record({'op': 'remove_document', 'filename': 'b.pdf'})
+    wal.write_bytes(first + second.replace(b'b.pdf', b'c.pdf') + first)
+
+    records, offset = read_wal(str(wal), 0)
+
+    assert len(records) == 1
+    assert offset == len(first)
+
+def test_writer_truncates_torn_tail(tmp_path):
+    state = SharedState(str(tmp_path))
+    state.add_document_vectors('a.pdf', ['a.pdf-chunk-0'])
+    with open(tmp_path / 'wal-0.log', 'ab') as f:
+        f.write(b'deadbeef {"op": "add_vec')
+
+    state.add_document_vectors('b.pdf', ['b.pdf-chunk-0'])
+
+    assert SharedState(str(tmp_path)).list_documents() == ['a.pdf', 'b.pdf']
+
+def test_readers_follow_log_across_snapshots(tmp_path):
+    writer = SharedState(str(tmp_path))
+    reader = SharedState(str(tmp_path))
+    writer.set_status('task', {'status': 'processing', 'processed_chunks': 0, 'total_chunks': 4})
+
+    assert reader.get_status('task')['status'] == 'processing'
+    assert writer.snapshot()
+    assert not writer.snapshot()
+
+    writer.add_document_vectors('a.pdf', ['a.pdf-chunk-0'])
+    writer.add_processed_chunks('task', 2)
+    assert writer.snapshot()
+    writer.add_document_vectors('a.pdf', ['a.pdf-chunk-1'])
+
+    for state in (reader, SharedState(str(tmp_path))):
+        assert state.get_document_vectors('a.pdf') == ['a.pdf-chunk-0', 'a.pdf-chunk-1']
+        assert state.get_status('task')['progress'] == 50.0
+    # Only the current and previous generations are kept
+    assert sorted(os.listdir(tmp_path)) == [
+        '.lock', 'snapshot-1', 'snapshot-2', 'snapshot.current', 'wal-1.log', 'wal-2.log'
+    ]
+
+def test_reader_reloads_after_falling_behind(tmp_path):
+    writer = SharedState(str(tmp_path))
+    idle_reader = SharedState(str(tmp_path))
+    writer.add_document_vectors('a.pdf', ['a.pdf-chunk-0'])
+    partial_reader = SharedState(str(tmp_path))
+    writer.add_document_vectors('b.pdf', ['b.pdf-chunk-0'])
+    writer.snapshot()
+    writer.add_document_vectors('c.pdf', ['c.pdf-chunk-0'])
+    writer.snapshot()
+
+    # wal-0 is gone, so both readers must reload rather than skip it
+    assert not (tmp_path / 'wal-0.log').exists()
+    for reader in (idle_reader, partial_reader):
+        assert reader.list_documents() == ['a.pdf', 'b.pdf', 'c.pdf']
+
+    for i in range(3):
+        writer.add_document_vectors(f'{i}.pdf', [f'{i}.pdf-chunk-0'])
+        writer.snapshot()
+    writer.remove_document('0.pdf')
+
+    assert idle_reader.list_documents() == ['a.pdf', 'b.pdf', 'c.pdf', '1.pdf', '2.pdf']
+
+def test_corrupt_snapshot_falls_back_to_previous(tmp_path):
+    writer = SharedState(str(tmp_path))
+    writer.add_document_vectors('a.pdf', ['a.pdf-chunk-0'])
+    writer.snapshot()
+    writer.add_document_vectors('b.pdf', ['b.pdf-chunk-0'])
+    writer.snapshot()
+    writer.add_document_vectors('c.pdf', ['c.pdf-chunk-0'])
+    (tmp_path / 'snapshot-2' / 'registry.json').write_text('{"documents": {}, "status": {}}')
+
+    assert SharedState(str(tmp_path)).list_documents() == ['a.pdf', 'b.pdf', 'c.pdf']
+
+def test_missing_snapshot_fails_at_startup(tmp_path):
+    (tmp_path / 'snapshot.current').write_text('7')
+
+    with pytest.raises(SnapshotError):
+        SharedState(str(tmp_path))
+
+def test_concurrent_writers_and_snapshots(tmp_path):
+    states = [SharedState(str(tmp_path)) for _ in range(3)]
+    states[0].set_status('task', {'status': 'processing', 'processed_chunks': 0, 'total_chunks': 200})
+
+    def write(state):
+        for _ in range(50):
+            state.add_processed_chunks('task', 1)
+
+    def snapshot():
+        for _ in range(10):
+            states[0].snapshot()
+
+    threads = [threading.Thread(target=write, args=(state,)) for state in states + states[:1]]
+    threads.append(threading.Thread(target=snapshot))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for state in states + [SharedState(str(tmp_path))]:
+        assert state.get_status('task')['processed_chunks'] == 200
+
+def test_one_snapshot_writer(tmp_path):
+    first = SharedState(str(tmp_path))
+    second = SharedState(str(tmp_path))
+
+    assert first.claim_snapshot_writer()
+    assert first.claim_snapshot_writer()
+    assert not second.claim_snapshot_writer()
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+def test_status_of_exited_worker_is_failed(tmp_path):
+    state = SharedState(str(tmp_path))
+    state.set_status('live', {'status': 'processing'})
+    state._log({'op': 'set_status', 'task_id': 'orphan', 'status': {'status': 'processing', 'pid': _dead_pid()}})
+
+    assert state.get_status('live') == {'status': 'processing'}
+    assert state.get_status('orphan')['status'] == 'failed'
+
+def test_snapshot_prunes_statuses(tmp_path):
+    state = SharedState(str(tmp_path))
+    state.set_status('live', {'status': 'processing'})
+    state.set_status('done', {'status': 'processing'})
+    state.update_status('done', status='completed')
+    state._log({'op': 'set_status', 'task_id': 'expired', 'status': {'status': 'failed', 'finished_at': 0}})
+    state._log({'op': 'set_status', 'task_id': 'orphan', 'status': {'status': 'processing', 'pid': _dead_pid()}})
+
+    state.snapshot()
+
+    restored = SharedState(str(tmp_path))
+    assert restored.get_status('live') == {'status': 'processing'}
+    assert restored.get_status('done') == {'status': 'completed'}
+    assert restored.get_status('expired') is None
+    assert restored.get_status('orphan') is None
+
+def _key(i):
+    return f'{i:032x}'
+
+def test_cache_entries_are_shared(tmp_path):
+    writer = SharedState(str(tmp_path))
+    reader = SharedState(str(tmp_path))
+    assert reader.get_cached_embedding(_key(1)) is None
+
+    writer.cache_embeddings({_key(1): [1.0, 2.0]})
+    writer.cache_embeddings({_key(2): [3.0, 4.0]})
+
+    assert reader.get_cached_embedding(_key(1)) == [1.0, 2.0]
+    assert reader.get_cached_embedding(_key(2)) == [3.0, 4.0]
+
+def test_cache_evicts_oldest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_state, 'CACHE_SIZE', 3)
+    state = SharedState(str(tmp_path))
+
+    state.cache_embeddings({_key(i): [float(i)] for i in range(2)})
+    state.cache_embeddings({_key(i): [float(i)] for i in range(2, 5)})
+
+    reader = SharedState(str(tmp_path))
+    assert [reader.get_cached_embedding(_key(i)) for i in range(5)] == [None, None, [2.0], [3.0], [4.0]]
+
+def test_cache_resets_when_dimension_changes(tmp_path):
+    state = SharedState(str(tmp_path))
+    state.cache_embeddings({_key(1): [1.0, 2.0]})
+
+    state.cache_embeddings({_key(2): [1.0, 2.0, 3.0]})
+
+    reader = SharedState(str(tmp_path))
+    assert reader.get_cached_embedding(_key(1)) is None
+    assert reader.get_cached_embedding(_key(2)) == [1.0, 2.0, 3.0]
+
+def test_cache_keeps_only_two_generations(tmp_path):
+    state = SharedState(str(tmp_path))
+    for i in range(4):
+        state.cache_embeddings({_key(i): [float(i)]})
+    # Entries already cached do not publish a new generation
+    state.cache_embeddings({_key(3): [3.0]})
+
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith('cache')) == [
+        'cache-3.keys.npy', 'cache-3.vectors.npy', 'cache-4.keys.npy', 'cache-4.vectors.npy', 'cache.current'
+    ]